@@ -147,6 +147,17 @@ def compute_metrics_on_folder(folder_ref: str, folder_pred: str, output_file: st
                      [ignore_label] * len(files_pred)))
         )
 
+    result = summarize_metrics_per_case(results, regions_or_labels)
+    if output_file is not None:
+        save_summary_json(result, output_file)
+    return result
+
+
+def summarize_metrics_per_case(results: List[dict],
+                               regions_or_labels: Union[List[int], List[Union[int, Tuple[int, ...]]]]) -> dict:
+    """
+    results is a list of outputs of compute_metrics. Returns the summary as it is written to summary.json
+    """
     # mean metric per class
     metric_list = list(results[0]['metrics'][regions_or_labels[0]].keys())
     means = {}
@@ -168,11 +179,7 @@ def compute_metrics_on_folder(folder_ref: str, folder_pred: str, output_file: st
     [recursive_fix_for_json_export(i) for i in results]
     recursive_fix_for_json_export(means)
     recursive_fix_for_json_export(foreground_mean)
-    result = {'metric_per_case': results, 'mean': means, 'foreground_mean': foreground_mean}
-    if output_file is not None:
-        save_summary_json(result, output_file)
-    return result
-    # print('DONE')
+    return {'metric_per_case': results, 'mean': means, 'foreground_mean': foreground_mean}
 
 
 def compute_metrics_on_folder2(folder_ref: str, folder_pred: str, dataset_json_file: str, plans_file: str,
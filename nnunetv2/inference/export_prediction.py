@@ -1,11 +1,14 @@
 import os
+import shutil
 from copy import deepcopy
+from multiprocessing import shared_memory
 from typing import Union, List
 
 import numpy as np
 import torch
 from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
 from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
+from threadpoolctl import threadpool_limits
 
 from nnunetv2.configuration import default_num_processes
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
@@ -69,18 +72,114 @@ def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits
         return segmentation_reverted_cropping
 
 
-def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, torch.Tensor], properties_dict: dict,
+def initialize_export_worker(num_threads_torch: int = 1):
+    """
+    Use as initializer of export pools. Each worker only needs a single thread. With many workers all using
+    default_num_processes threads we would massively oversubscribe the CPU.
+    Setting OMP_NUM_THREADS etc here would be too late: numpy/torch are already imported (forkserver preload) and
+    their BLAS/OpenMP pools only read these at load time. threadpoolctl limits the already loaded pools instead
+    """
+    threadpool_limits(limits=num_threads_torch, user_api=None)
+    torch.set_num_threads(num_threads_torch)
+
+
+class SharedMemoryPrediction(object):
+    def __init__(self, prediction: np.ndarray):
+        """
+        Copies prediction into a shared memory block. When this object is sent to a background worker, only the name
+        of the block, shape and dtype are pickled. Call release() in the process that created it once all workers are
+        done with it
+        """
+        self.shape = prediction.shape
+        self.dtype = prediction.dtype
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, prediction.nbytes))
+        self.name = self._shm.name
+        np.copyto(np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf), prediction)
+
+    def __getstate__(self):
+        return {'shape': self.shape, 'dtype': self.dtype, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = None
+
+    def load(self) -> np.ndarray:
+        # we copy the array out of the block so that we don't have to worry about closing the block while there are
+        # still views on it floating around
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            arr = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+        return arr
+
+    def release(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def _shared_memory_available(num_bytes: int) -> bool:
+    # writing to a block that does not fit into /dev/shm does not fail gracefully, the process dies with SIGBUS.
+    # Platforms without /dev/shm don't have this limitation
+    if not os.path.isdir('/dev/shm'):
+        return True
+    return num_bytes < shutil.disk_usage('/dev/shm').free
+
+
+def prepare_prediction_for_export(prediction: Union[np.ndarray, torch.Tensor], output_file_truncated: str,
+                                  dtype: Union[np.dtype, type, None] = np.float16) \
+        -> Union[SharedMemoryPrediction, str]:
+    """
+    Makes the prediction available to background workers without having to pickle the (potentially huge) array.
+    We use shared memory if possible. If there is not enough of it the prediction is saved as
+    output_file_truncated + '.npy' and the workers read it from disk. The caller is responsible for calling
+    release_prediction_for_export once all workers using the prediction are done.
+
+    Floating point predictions are handed over as dtype (None: keep as is). fp16 is plenty for logits and halves
+    the memory/disk footprint. The export functions upcast where needed (see apply_inference_nonlin)
+    """
+    if isinstance(prediction, torch.Tensor):
+        prediction = prediction.numpy()
+    if dtype is not None and np.issubdtype(prediction.dtype, np.floating) and prediction.dtype != dtype:
+        prediction = prediction.astype(dtype)
+    if _shared_memory_available(prediction.nbytes):
+        try:
+            return SharedMemoryPrediction(prediction)
+        except OSError:
+            pass
+    prediction_file = output_file_truncated + '.npy'
+    np.save(prediction_file, prediction)
+    return prediction_file
+
+
+def load_prediction_for_export(predicted_array_or_file: Union[np.ndarray, torch.Tensor, str, SharedMemoryPrediction]) \
+        -> Union[np.ndarray, torch.Tensor]:
+    if isinstance(predicted_array_or_file, SharedMemoryPrediction):
+        return predicted_array_or_file.load()
+    if isinstance(predicted_array_or_file, str):
+        return np.load(predicted_array_or_file, mmap_mode='r')
+    return predicted_array_or_file
+
+
+def release_prediction_for_export(predicted_array_or_file: Union[np.ndarray, torch.Tensor, str,
+                                                                 SharedMemoryPrediction]) -> None:
+    if isinstance(predicted_array_or_file, SharedMemoryPrediction):
+        predicted_array_or_file.release()
+    elif isinstance(predicted_array_or_file, str) and isfile(predicted_array_or_file):
+        os.remove(predicted_array_or_file)
+
+
+def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, torch.Tensor, str, SharedMemoryPrediction],
+                                  properties_dict: dict,
                                   configuration_manager: ConfigurationManager,
                                   plans_manager: PlansManager,
                                   dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
-                                  save_probabilities: bool = False):
-    # if isinstance(predicted_array_or_file, str):
-    #     tmp = deepcopy(predicted_array_or_file)
-    #     if predicted_array_or_file.endswith('.npy'):
-    #         predicted_array_or_file = np.load(predicted_array_or_file)
-    #     elif predicted_array_or_file.endswith('.npz'):
-    #         predicted_array_or_file = np.load(predicted_array_or_file)['softmax']
-    #     os.remove(tmp)
+                                  save_probabilities: bool = False,
+                                  num_threads_torch: int = default_num_processes):
+    # files/shared memory are not released here, see prepare_prediction_for_export
+    predicted_array_or_file = load_prediction_for_export(predicted_array_or_file)
 
     if isinstance(dataset_json_dict_or_file, str):
         dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
@@ -88,7 +187,7 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
     label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
     ret = convert_predicted_logits_to_segmentation_with_correct_shape(
         predicted_array_or_file, plans_manager, configuration_manager, label_manager, properties_dict,
-        return_probabilities=save_probabilities
+        return_probabilities=save_probabilities, num_threads_torch=num_threads_torch
     )
     del predicted_array_or_file
 
@@ -107,17 +206,12 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
                  properties_dict)
 
 
-def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape: List[int], output_file: str,
-                      plans_manager: PlansManager, configuration_manager: ConfigurationManager, properties_dict: dict,
-                      dataset_json_dict_or_file: Union[dict, str], num_threads_torch: int = default_num_processes) \
-        -> None:
-    # # needed for cascade
-    # if isinstance(predicted, str):
-    #     assert isfile(predicted), "If isinstance(segmentation_softmax, str) then " \
-    #                               "isfile(segmentation_softmax) must be True"
-    #     del_file = deepcopy(predicted)
-    #     predicted = np.load(predicted)
-    #     os.remove(del_file)
+def resample_and_save(predicted: Union[torch.Tensor, np.ndarray, str, SharedMemoryPrediction], target_shape: List[int],
+                      output_file: str, plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                      properties_dict: dict, dataset_json_dict_or_file: Union[dict, str],
+                      num_threads_torch: int = default_num_processes) -> None:
+    # needed for cascade. Files/shared memory are not released here, see prepare_prediction_for_export
+    predicted = load_prediction_for_export(predicted)
     old_threads = torch.get_num_threads()
     torch.set_num_threads(num_threads_torch)
 
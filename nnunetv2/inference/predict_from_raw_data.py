@@ -43,7 +43,8 @@ class nnUNetPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 tile_batch_size: int = 1):
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -61,6 +62,12 @@ class nnUNetPredictor(object):
             perform_everything_on_device = False
         self.device = device
         self.perform_everything_on_device = perform_everything_on_device
+        # run all mirrored versions of a tile through the network in one batch. Is set to False automatically if we
+        # run out of VRAM, see _internal_maybe_mirror_and_predict
+        self.mirror_in_batch = True
+        # number of sliding window tiles that go through the network together. Is set to 1 automatically if we run
+        # out of VRAM during a forward pass, see _internal_predict_tile_batch
+        self.tile_batch_size = tile_batch_size
 
     def initialize_from_trained_model_folder(self, model_training_output_dir: str,
                                              use_folds: Union[Tuple[Union[int, str]], None],
@@ -534,29 +541,146 @@ class nnUNetPredictor(object):
                                                   zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
         return slicers
 
+    def _internal_get_memory_format(self) -> torch.memory_format:
+        """
+        On cuda, convolutions with fp16 (autocast) can run faster in channels last memory format because that is what
+        tensor cores want. Opt-in via nnUNet_channels_last=1: instance norm (used by the standard nnU-Net
+        architectures) has no native channels_last_3d kernel, so networks using it may end up slower. If enabled we
+        use it for the network as well as the tiles we feed into it
+        """
+        if self.device.type != 'cuda' or not (
+                'nnUNet_channels_last' in os.environ.keys() and
+                os.environ['nnUNet_channels_last'].lower() in ('true', '1', 't')):
+            return torch.contiguous_format
+        return torch.channels_last if len(self.configuration_manager.patch_size) == 2 else torch.channels_last_3d
+
+    def get_num_sliding_window_tiles(self, image_size: Tuple[int, ...]) -> int:
+        """
+        Number of tiles the sliding window prediction of an image of shape image_size (without channel dimension)
+        needs. Accounts for the padding of images that are smaller than the patch size
+        """
+        patch_size = self.configuration_manager.patch_size
+        num_unpadded = len(image_size) - len(patch_size)
+        padded_size = [*image_size[:num_unpadded],
+                       *[max(i, p) for i, p in zip(image_size[num_unpadded:], patch_size)]]
+        return len(self._internal_get_sliding_window_slicers(padded_size))
+
+    def _internal_get_tiles_on_device(self, data: List[torch.Tensor], tiles: List[Tuple[int, tuple]]):
+        """
+        tiles is a list of (index of the image in data, slicer). Yields (tiles in batch, batch) where batch holds up
+        to self.tile_batch_size tiles, is on self.device and in the memory format the network wants. If data is not on
+        the device (results arrays on CPU) and we use cuda, tiles are staged in pinned memory and uploaded on a
+        separate stream so that the upload of the next batch runs while the network is still busy with the current one
+        """
+        memory_format = self._internal_get_memory_format()
+        batches = [tiles[i:i + self.tile_batch_size] for i in range(0, len(tiles), self.tile_batch_size)]
+        # compare is_cuda, not devices: torch.device('cuda') != torch.device('cuda:0')
+        if self.device.type != 'cuda' or all([d.is_cuda for d in data]):
+            for batch_tiles in batches:
+                yield batch_tiles, torch.stack([data[c][sl] for c, sl in batch_tiles]).to(self.device,
+                                                                                         memory_format=memory_format)
+            return
+        # staging is for host data only. Data on the GPU would make a round trip through host memory
+        assert not any([d.is_cuda for d in data]), 'either all or none of the images must be on the device'
+
+        copy_stream = torch.cuda.Stream(self.device)
+        compute_stream = torch.cuda.current_stream(self.device)
+        # two staging buffers: one is filled while the other one may still be uploading
+        c, sl = tiles[0]
+        staging = [torch.empty((len(batches[0]), *data[c][sl].shape), dtype=data[c].dtype, pin_memory=True)
+                   for _ in range(2)]
+        upload_done = [None, None]
+
+        def upload(k):
+            b = k % 2
+            if upload_done[b] is not None:
+                # must not overwrite a staging buffer that is still being copied from
+                upload_done[b].synchronize()
+            for j, (c, sl) in enumerate(batches[k]):
+                staging[b][j].copy_(data[c][sl])
+            with torch.cuda.stream(copy_stream):
+                batch = staging[b][:len(batches[k])].to(self.device, non_blocking=True)
+                upload_done[b] = torch.cuda.Event()
+                upload_done[b].record(copy_stream)
+            return batch, upload_done[b]
+
+        next_batch = upload(0)
+        for k, batch_tiles in enumerate(batches):
+            batch, event = next_batch
+            if k + 1 < len(batches):
+                next_batch = upload(k + 1)
+            compute_stream.wait_event(event)
+            # batch was allocated on copy_stream. The caching allocator needs to know that it is used on compute_stream
+            batch.record_stream(compute_stream)
+            yield batch_tiles, batch.to(memory_format=memory_format)
+
     def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
         mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
-        prediction = self.network(x)
+        if mirror_axes is None:
+            return self.network(x)
+
+        # check for invalid numbers in mirror_axes
+        # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
+        assert max(mirror_axes) <= x.ndim - 3, 'mirror_axes does not match the dimension of the input!'
+
+        mirror_axes = [m + 2 for m in mirror_axes]
+        axes_combinations = [
+            c for i in range(len(mirror_axes)) for c in itertools.combinations(mirror_axes, i + 1)
+        ]
+
+        if self.mirror_in_batch:
+            # one forward pass with a large batch is a lot faster than many with small ones (fewer kernel launches,
+            # better GPU utilization). Costs more VRAM though
+            try:
+                b = x.shape[0]
+                predictions = self.network(torch.cat([x] + [torch.flip(x, axes) for axes in axes_combinations]))
+                prediction = predictions[:b]
+                for i, axes in enumerate(axes_combinations):
+                    prediction += torch.flip(predictions[(i + 1) * b:(i + 2) * b], axes)
+                prediction /= (len(axes_combinations) + 1)
+                return prediction
+            except torch.cuda.OutOfMemoryError:
+                print('Not enough VRAM to predict all mirrored versions of a tile in one batch. Falling back to one '
+                      'forward pass per mirroring')
+                self.mirror_in_batch = False
+                empty_cache(self.device)
 
-        if mirror_axes is not None:
-            # check for invalid numbers in mirror_axes
-            # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
-            assert max(mirror_axes) <= x.ndim - 3, 'mirror_axes does not match the dimension of the input!'
-
-            mirror_axes = [m + 2 for m in mirror_axes]
-            axes_combinations = [
-                c for i in range(len(mirror_axes)) for c in itertools.combinations(mirror_axes, i + 1)
-            ]
-            for axes in axes_combinations:
-                prediction += torch.flip(self.network(torch.flip(x, axes)), axes)
-            prediction /= (len(axes_combinations) + 1)
+        prediction = self.network(x)
+        for axes in axes_combinations:
+            prediction += torch.flip(self.network(torch.flip(x, axes)), axes)
+        prediction /= (len(axes_combinations) + 1)
         return prediction
 
+    def _internal_predict_tile_batch(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Runs a batch of tiles through the network. If that does not fit into VRAM we predict the tiles one by one
+        and stick to one tile per forward pass from then on. Only OOMs in the forward pass end up here, running out
+        of memory for the results arrays is handled by moving them to the CPU (see
+        predict_sliding_window_return_logits_batched)
+        """
+        if x.shape[0] > self.tile_batch_size:
+            # batches that were put together before we ran out of VRAM
+            return torch.cat([self._internal_maybe_mirror_and_predict(x[j:j + 1]) for j in range(x.shape[0])])
+        try:
+            return self._internal_maybe_mirror_and_predict(x)
+        except torch.cuda.OutOfMemoryError:
+            if x.shape[0] == 1:
+                raise
+            print(f'Not enough VRAM to predict {x.shape[0]} tiles in one batch. Falling back to one tile per '
+                  f'forward pass')
+            self.tile_batch_size = 1
+            empty_cache(self.device)
+            return torch.cat([self._internal_maybe_mirror_and_predict(x[j:j + 1]) for j in range(x.shape[0])])
+
     def _internal_predict_sliding_window_return_logits(self,
-                                                       data: torch.Tensor,
-                                                       slicers,
+                                                       data: List[torch.Tensor],
+                                                       tiles: List[Tuple[int, tuple]],
                                                        do_on_device: bool = True,
-                                                       ):
+                                                       ) -> List[torch.Tensor]:
+        """
+        data is a list of (padded) images, tiles a list of (index of the image in data, slicer). Returns the
+        predicted logits of each image
+        """
         predicted_logits = n_predictions = prediction = gaussian = workon = None
         results_device = self.device if do_on_device else torch.device('cpu')
 
@@ -566,15 +690,18 @@ class nnUNetPredictor(object):
             # move data to device
             if self.verbose:
                 print(f'move image to device {results_device}')
-            data = data.to(results_device)
+            # host to device copies of pinned memory (see nnUNetTrainer.perform_actual_validation) can be non_blocking,
+            # the copy is stream ordered with everything we do on the device afterwards. Copies to the CPU must block
+            # because we read the results on the CPU right away
+            data = [d.to(results_device, non_blocking=results_device.type == 'cuda') for d in data]
 
             # preallocate arrays
             if self.verbose:
                 print(f'preallocating results arrays on device {results_device}')
-            predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                           dtype=torch.half,
-                                           device=results_device)
-            n_predictions = torch.zeros(data.shape[1:], dtype=torch.half, device=results_device)
+            predicted_logits = [torch.zeros((self.label_manager.num_segmentation_heads, *d.shape[1:]),
+                                            dtype=torch.half,
+                                            device=results_device) for d in data]
+            n_predictions = [torch.zeros(d.shape[1:], dtype=torch.half, device=results_device) for d in data]
 
             if self.use_gaussian:
                 gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
@@ -584,24 +711,26 @@ class nnUNetPredictor(object):
                 gaussian = 1
 
             if not self.allow_tqdm and self.verbose:
-                print(f'running prediction: {len(slicers)} steps')
-            for sl in tqdm(slicers, disable=not self.allow_tqdm):
-                workon = data[sl][None]
-                workon = workon.to(self.device)
-
-                prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
-
-                if self.use_gaussian:
-                    prediction *= gaussian
-                predicted_logits[sl] += prediction
-                n_predictions[sl[1:]] += gaussian
-
-            predicted_logits /= n_predictions
-            # check for infs
-            if torch.any(torch.isinf(predicted_logits)):
-                raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
-                                   'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
-                                   'predicted_logits to fp32')
+                print(f'running prediction: {len(tiles)} steps')
+            with tqdm(total=len(tiles), disable=not self.allow_tqdm) as pbar:
+                for batch_tiles, workon in self._internal_get_tiles_on_device(data, tiles):
+                    prediction = self._internal_predict_tile_batch(workon).to(results_device)
+
+                    for j, (c, sl) in enumerate(batch_tiles):
+                        if self.use_gaussian:
+                            predicted_logits[c][sl] += prediction[j] * gaussian
+                        else:
+                            predicted_logits[c][sl] += prediction[j]
+                        n_predictions[c][sl[1:]] += gaussian
+                    pbar.update(len(batch_tiles))
+
+            for p, n in zip(predicted_logits, n_predictions):
+                p /= n
+                # check for infs
+                if torch.any(torch.isinf(p)):
+                    raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
+                                       'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
+                                       'predicted_logits to fp32')
         except Exception as e:
             del predicted_logits, n_predictions, prediction, gaussian, workon
             empty_cache(self.device)
@@ -611,9 +740,18 @@ class nnUNetPredictor(object):
 
     def predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
             -> Union[np.ndarray, torch.Tensor]:
+        return self.predict_sliding_window_return_logits_batched([input_image])[0]
+
+    def predict_sliding_window_return_logits_batched(self, input_images: List[torch.Tensor]) -> List[torch.Tensor]:
+        """
+        Same as predict_sliding_window_return_logits but for several images at once. The tiles of all images go
+        through the network together in batches of up to self.tile_batch_size tiles. This keeps the GPU busy even if
+        the images are so small that each of them only has a handful of tiles. All images need the same number of
+        channels
+        """
         with torch.no_grad():
-            assert isinstance(input_image, torch.Tensor)
-            self.network = self.network.to(self.device)
+            assert all([isinstance(i, torch.Tensor) for i in input_images])
+            self.network = self.network.to(self.device, memory_format=self._internal_get_memory_format())
             self.network.eval()
 
             empty_cache(self.device)
@@ -625,37 +763,43 @@ class nnUNetPredictor(object):
             # is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
             # So autocast will only be active if we have a cuda device.
             with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
-                assert input_image.ndim == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
-
-                if self.verbose:
-                    print(f'Input shape: {input_image.shape}')
-                    print("step_size:", self.tile_step_size)
-                    print("mirror_axes:", self.allowed_mirroring_axes if self.use_mirroring else None)
-
-                # if input_image is smaller than tile_size we need to pad it to tile_size.
-                data, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
-                                                           'constant', {'value': 0}, True,
-                                                           None)
-
-                slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+                data = []
+                slicers_revert_padding = []
+                tiles = []
+                for c, input_image in enumerate(input_images):
+                    assert input_image.ndim == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
+
+                    if self.verbose:
+                        print(f'Input shape: {input_image.shape}')
+                        print("step_size:", self.tile_step_size)
+                        print("mirror_axes:", self.allowed_mirroring_axes if self.use_mirroring else None)
+
+                    # if input_image is smaller than tile_size we need to pad it to tile_size.
+                    d, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
+                                                            'constant', {'value': 0}, True,
+                                                            None)
+                    data.append(d)
+                    slicers_revert_padding.append(slicer_revert_padding)
+                    tiles += [(c, sl) for sl in self._internal_get_sliding_window_slicers(d.shape[1:])]
 
                 if self.perform_everything_on_device and self.device != 'cpu':
                     # we need to try except here because we can run OOM in which case we need to fall back to CPU as a results device
                     try:
-                        predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                               self.perform_everything_on_device)
+                        predicted_logits = self._internal_predict_sliding_window_return_logits(
+                            data, tiles, self.perform_everything_on_device)
                     except RuntimeError:
                         print(
                             'Prediction on device was unsuccessful, probably due to a lack of memory. Moving results arrays to CPU')
                         empty_cache(self.device)
-                        predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False)
+                        predicted_logits = self._internal_predict_sliding_window_return_logits(
+                            data, tiles, False)
                 else:
-                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                           self.perform_everything_on_device)
+                    predicted_logits = self._internal_predict_sliding_window_return_logits(
+                        data, tiles, self.perform_everything_on_device)
 
                 empty_cache(self.device)
                 # revert padding
-                predicted_logits = predicted_logits[(slice(None), *slicer_revert_padding[1:])]
+                predicted_logits = [p[(slice(None), *s[1:])] for p, s in zip(predicted_logits, slicers_revert_padding)]
         return predicted_logits
 
 
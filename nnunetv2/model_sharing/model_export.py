@@ -45,7 +45,7 @@ def export_pretrained_model(dataset_name_or_id: Union[int, str], output_file: st
                 source_file = join(trainer_output_dir, fold_folder, "progress.png")
                 zipf.write(source_file, os.path.relpath(source_file, nnUNet_results))
 
-                # if it exists, network architecture.png
+                # if it exists, network architecture.pdf (older trainings have one per fold)
                 source_file = join(trainer_output_dir, fold_folder, "network_architecture.pdf")
                 if isfile(source_file):
                     zipf.write(source_file, os.path.relpath(source_file, nnUNet_results))
@@ -73,6 +73,10 @@ def export_pretrained_model(dataset_name_or_id: Union[int, str], output_file: st
                 for s in source_files:
                     if isfile(s):
                         zipf.write(s, os.path.relpath(s, nnUNet_results))
+            # network architecture.pdf (if it was plotted), shared by all folds
+            source_file = join(trainer_output_dir, "network_architecture.pdf")
+            if isfile(source_file):
+                zipf.write(source_file, os.path.relpath(source_file, nnUNet_results))
             # plans
             source_file = join(trainer_output_dir, "plans.json")
             zipf.write(source_file, os.path.relpath(source_file, nnUNet_results))
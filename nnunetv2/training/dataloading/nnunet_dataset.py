@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import numpy as np
@@ -111,6 +112,53 @@ class nnUNetDataset(object):
         return data, seg, entry['properties']
 
 
+def _load_npy_or_npz_member(npy_file: str, npz_file: str, member: str) -> np.ndarray:
+    if isfile(npy_file):
+        return np.load(npy_file, 'r')
+    return np.load(npz_file)[member]
+
+
+class nnUNetValidationDataset(nnUNetDataset):
+    def __init__(self, folder: str, case_identifiers: List[str] = None,
+                 num_images_properties_loading_threshold: int = 0,
+                 folder_with_segs_from_previous_stage: str = None,
+                 load_segmentation: bool = True):
+        """
+        nnUNetDataset for reading each case once, as in nnUNetTrainer.perform_actual_validation. Unpacked (.npy)
+        files are memmapped just like in nnUNetDataset. Arrays that are only available in an npz file are
+        decompressed in parallel threads (zlib releases the GIL) instead of one after the other.
+
+        If load_segmentation is False the reference segmentation is not loaded at all. load_case then returns the
+        segmentation from the previous stage as seg (shape (1, x, y(, z))), or None if there is no previous stage
+        """
+        super().__init__(folder, case_identifiers, num_images_properties_loading_threshold,
+                         folder_with_segs_from_previous_stage)
+        self.load_segmentation = load_segmentation
+
+    def load_case(self, key):
+        entry = self[key]
+        # (npy file, npz file, name of the array in the npz file) of everything we need
+        to_load = [(entry['data_file'][:-4] + ".npy", entry['data_file'], 'data')]
+        if self.load_segmentation:
+            to_load.append((entry['data_file'][:-4] + "_seg.npy", entry['data_file'], 'seg'))
+        if 'seg_from_prev_stage_file' in entry.keys():
+            to_load.append((entry['seg_from_prev_stage_file'][:-4] + ".npy", entry['seg_from_prev_stage_file'],
+                            'seg'))
+
+        if sum([not isfile(npy_file) for npy_file, _, _ in to_load]) > 1:
+            # each thread opens the npz file itself, NpzFile is not thread safe
+            with ThreadPoolExecutor(max_workers=len(to_load)) as executor:
+                loaded = list(executor.map(_load_npy_or_npz_member, *zip(*to_load)))
+        else:
+            loaded = [_load_npy_or_npz_member(*i) for i in to_load]
+
+        data = loaded[0]
+        seg = loaded[1] if self.load_segmentation else None
+        if 'seg_from_prev_stage_file' in entry.keys():
+            seg = loaded[-1][None] if seg is None else np.vstack((seg, loaded[-1][None]))
+        return data, seg, entry['properties']
+
+
 if __name__ == '__main__':
     # this is a mini test. Todo: We can move this to tests in the future (requires simulated dataset)
 
@@ -4,8 +4,12 @@ import os
 import shutil
 import sys
 import warnings
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
+from multiprocessing import Pool
 from time import time, sleep
 from typing import Tuple, Union, List
 
@@ -44,15 +48,15 @@ from torch.cuda.amp import GradScaler
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from nnunetv2.configuration import ANISO_THRESHOLD, default_num_processes
-from nnunetv2.evaluation.evaluate_predictions import compute_metrics_on_folder
-from nnunetv2.inference.export_prediction import export_prediction_from_logits, resample_and_save
+from nnunetv2.evaluation.evaluate_predictions import compute_metrics, summarize_metrics_per_case, save_summary_json
+from nnunetv2.inference.export_prediction import export_prediction_from_logits, resample_and_save, \
+    prepare_prediction_for_export, release_prediction_for_export, initialize_export_worker
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
-from nnunetv2.inference.sliding_window_prediction import compute_gaussian
 from nnunetv2.paths import nnUNet_preprocessed, nnUNet_results
 from nnunetv2.training.data_augmentation.compute_initial_patch_size import get_patch_size
 from nnunetv2.training.dataloading.data_loader_2d import nnUNetDataLoader2D
 from nnunetv2.training.dataloading.data_loader_3d import nnUNetDataLoader3D
-from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
+from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset, nnUNetValidationDataset
 from nnunetv2.training.dataloading.utils import get_case_identifiers, unpack_dataset
 from nnunetv2.training.logging.nnunet_logger import nnUNetLogger
 from nnunetv2.training.loss.compound_losses import DC_and_CE_loss, DC_and_BCE_loss
@@ -184,6 +188,8 @@ class nnUNetTrainer(object):
         self.inference_allowed_mirroring_axes = None  # this variable is set in
         # self.configure_rotation_dummyDA_mirroring_and_inital_patch_size and will be saved in checkpoints
 
+        self._export_pool = self._export_pool_finalizer = None  # see self._get_export_pool
+
         ### checkpoint saving stuff
         self.save_every = 50
         self.disable_checkpointing = False
@@ -513,6 +519,11 @@ class nnUNetTrainer(object):
             self.print_to_log_file("Unable to plot network architecture: nnUNet_compile is enabled!")
             return
 
+        # the architecture is the same for all folds, so they share one plot
+        output_file = join(self.output_folder_base, "network_architecture.pdf")
+        if isfile(output_file):
+            return
+
         if self.local_rank == 0:
             try:
                 # raise NotImplementedError('hiddenlayer no longer works and we do not have a viable alternative :-(')
@@ -534,7 +545,7 @@ class nnUNetTrainer(object):
                                                *self.configuration_manager.patch_size),
                                               device=self.device),
                                    transforms=None)
-                g.save(join(self.output_folder, "network_architecture.pdf"))
+                g.save(output_file)
                 del g
             except Exception as e:
                 self.print_to_log_file("Unable to plot network architecture:")
@@ -928,11 +939,18 @@ class nnUNetTrainer(object):
         save_json(self.dataset_json, join(self.output_folder_base, 'dataset.json'), sort_keys=False)
 
         # we don't really need the fingerprint but its still handy to have it with the others
-        shutil.copy(join(self.preprocessed_dataset_folder_base, 'dataset_fingerprint.json'),
-                    join(self.output_folder_base, 'dataset_fingerprint.json'))
-
-        # produces a pdf in output folder
-        self.plot_network_architecture()
+        if self.local_rank == 0:
+            fingerprint_target = join(self.output_folder_base, 'dataset_fingerprint.json')
+            if isfile(fingerprint_target) and os.stat(fingerprint_target).st_nlink > 1:
+                # hard link left behind by an earlier version. Copying through it would modify the preprocessed file
+                os.remove(fingerprint_target)
+            shutil.copy(join(self.preprocessed_dataset_folder_base, 'dataset_fingerprint.json'), fingerprint_target)
+
+        # produces a pdf in output_folder_base. Opt-in because it costs a dummy forward pass (time and VRAM) at the
+        # start of each training
+        if 'nnUNet_plot_architecture' in os.environ.keys() and \
+                os.environ['nnUNet_plot_architecture'].lower() in ('true', '1', 't'):
+            self.plot_network_architecture()
 
         self._save_debug_information()
 
@@ -962,6 +980,8 @@ class nnUNetTrainer(object):
                 self.dataloader_val._finish()
             sys.stdout = old_stdout
 
+        self._close_export_pool()
+
         empty_cache(self.device)
         self.print_to_log_file("Training done.")
 
@@ -1214,6 +1234,136 @@ class nnUNetTrainer(object):
             if checkpoint['grad_scaler_state'] is not None:
                 self.grad_scaler.load_state_dict(checkpoint['grad_scaler_state'])
 
+    def _load_case_for_validation(self, dataset_val: nnUNetValidationDataset, key: str) -> Tuple[torch.Tensor, dict]:
+        """
+        This is run in a background thread by perform_actual_validation. Returns the data as torch.Tensor (with the
+        segmentation from the previous stage stacked on top if we are cascaded) and the properties of the case
+        """
+        data, seg, properties = dataset_val.load_case(key)
+        # pinned memory lets the predictor copy the data to the GPU with non_blocking=True. This also forces
+        # memmapped (unpacked) data to be read here and not in the main thread
+        pin_memory = self.device.type == 'cuda'
+
+        if not self.is_cascaded and not pin_memory:
+            with warnings.catch_warnings():
+                # ignore 'The given NumPy array is not writable' warning
+                warnings.simplefilter("ignore")
+                return torch.from_numpy(data), properties
+
+        # we allocate the final (pinned) tensor right away and write the data and the one hot encoded segmentation
+        # of the previous stage into it. np.vstack + pin_memory would need two more copies of everything and a
+        # temporary one hot array
+        num_fg_labels = len(self.label_manager.foreground_labels) if self.is_cascaded else 0
+        result = torch.empty((data.shape[0] + num_fg_labels, *data.shape[1:]), dtype=torch.float32,
+                             pin_memory=pin_memory)
+        result_npy = result.numpy()
+        result_npy[:data.shape[0]] = data
+        if self.is_cascaded:
+            convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
+                                        out=result_npy[data.shape[0]:])
+        return result, properties
+
+    def _get_export_pool(self) -> Pool:
+        """
+        The export pool is created on first use and then reused by every following call to
+        perform_actual_validation, so that we only have to pay for starting the workers once. Note that
+        run_training.py validates after on_train_end, so we cannot rely on that to shut the pool down. It is closed
+        and joined by _close_export_pool or, at the latest, when the trainer is garbage collected or the interpreter
+        exits (weakref.finalize)
+        """
+        if self._export_pool is None:
+            # forkserver (like spawn) does not copy the CUDA state of this process into the workers. Workers are
+            # forked from a clean server process, which is much cheaper than spawning a new interpreter each time.
+            # Windows only has spawn
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            context = multiprocessing.get_context(start_method)
+            if start_method == 'forkserver':
+                # the server imports this once, all workers forked from it have numpy, torch etc. ready to go.
+                # Has no effect if the server is already running
+                context.set_forkserver_preload(['nnunetv2.inference.export_prediction'])
+            # with DDP every rank has its own export pool. The ranks on this node share the CPUs, so they also need
+            # to share default_num_processes
+            if self.is_ddp:
+                num_export_processes = max(1, default_num_processes //
+                                           max(1, min(dist.get_world_size(), device_count())))
+            else:
+                num_export_processes = default_num_processes
+            self._export_pool = context.Pool(num_export_processes, initializer=initialize_export_worker,
+                                             initargs=(1,), maxtasksperchild=16)
+            self._export_pool_finalizer = weakref.finalize(self, nnUNetTrainer._shutdown_export_pool,
+                                                           self._export_pool)
+        return self._export_pool
+
+    @staticmethod
+    def _shutdown_export_pool(pool: Pool):
+        # must not reference the trainer, otherwise weakref.finalize keeps it alive
+        pool.close()
+        pool.join()
+
+    def _close_export_pool(self):
+        if self._export_pool_finalizer is not None:
+            # calling the finalizer runs _shutdown_export_pool (at most once) and detaches it
+            self._export_pool_finalizer()
+        self._export_pool = self._export_pool_finalizer = None
+
+    def _sort_keys_by_size(self, keys: List[str]) -> List[str]:
+        """
+        Sorts keys by the size of their preprocessed file (unpacked .npy if available, else .npz), largest first.
+        File sizes are a cheap estimate of how long a case takes. Ties are broken by name so that all DDP ranks end
+        up with the same order
+        """
+        sizes = {}
+        for k in keys:
+            npy_file = join(self.preprocessed_dataset_folder, k + '.npy')
+            npz_file = join(self.preprocessed_dataset_folder, k + '.npz')
+            sizes[k] = os.path.getsize(npy_file) if isfile(npy_file) else \
+                os.path.getsize(npz_file) if isfile(npz_file) else 0
+        return sorted(keys, key=lambda k: (-sizes[k], k))
+
+    def _predict_validation_cases(self, predictor: nnUNetPredictor, dataset_val: nnUNetValidationDataset,
+                                  keys: List[str]):
+        """
+        Generator used by perform_actual_validation. Yields (key, prediction, properties) in the order of keys.
+        Cases are loaded in background threads so that disk I/O and decompression of the next cases can happen while
+        the GPU is busy with the current one (load_case is mostly numpy/zlib which release the GIL). Cases that are
+        too small to fill a batch of predictor.tile_batch_size tiles on their own are predicted together with the
+        next (small) cases so that their tiles can share forward passes
+        """
+        num_cases_prefetched = 2
+        case_loader = ThreadPoolExecutor(max_workers=num_cases_prefetched)
+        prefetched_cases = deque()
+        next_key_idx = 0
+
+        def load_case(k):
+            data, properties = self._load_case_for_validation(dataset_val, k)
+            self.print_to_log_file(f'{k}, shape {data.shape}, rank {self.local_rank}')
+            return k, data, properties, predictor.get_num_sliding_window_tiles(data.shape[1:])
+
+        try:
+            while next_key_idx < len(keys) or len(prefetched_cases) > 0:
+                while len(prefetched_cases) < num_cases_prefetched and next_key_idx < len(keys):
+                    prefetched_cases.append(case_loader.submit(load_case, keys[next_key_idx]))
+                    next_key_idx += 1
+
+                group = [prefetched_cases.popleft().result()]
+                num_tiles = group[0][3]
+                # only wait for the next case if the current one leaves room in the batch. Large cases must not
+                # keep the GPU waiting for the loader
+                while num_tiles < predictor.tile_batch_size and len(prefetched_cases) > 0 and \
+                        num_tiles + prefetched_cases[0].result()[3] <= predictor.tile_batch_size:
+                    group.append(prefetched_cases.popleft().result())
+                    num_tiles += group[-1][3]
+                    if next_key_idx < len(keys):
+                        prefetched_cases.append(case_loader.submit(load_case, keys[next_key_idx]))
+                        next_key_idx += 1
+
+                self.print_to_log_file(f"predicting {', '.join([k for k, _, _, _ in group])}")
+                predictions = predictor.predict_sliding_window_return_logits_batched([d for _, d, _, _ in group])
+                for (k, _, properties, _), prediction in zip(group, predictions):
+                    yield k, prediction, properties
+        finally:
+            case_loader.shutdown(cancel_futures=True)
+
     def perform_actual_validation(self, save_probabilities: bool = False):
         self.set_deep_supervision_enabled(False)
         self.network.eval()
@@ -1230,133 +1380,193 @@ class nnUNetTrainer(object):
 
         predictor = nnUNetPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=True,
                                     perform_everything_on_device=True, device=self.device, verbose=False,
-                                    verbose_preprocessing=False, allow_tqdm=False)
+                                    verbose_preprocessing=False, allow_tqdm=False,
+                                    tile_batch_size=self.batch_size)
         predictor.manual_initialization(self.network, self.plans_manager, self.configuration_manager, None,
                                         self.dataset_json, self.__class__.__name__,
                                         self.inference_allowed_mirroring_axes)
 
-        with multiprocessing.get_context("spawn").Pool(default_num_processes) as segmentation_export_pool:
-            worker_list = [i for i in segmentation_export_pool._pool]
-            validation_output_folder = join(self.output_folder, 'validation')
-            maybe_mkdir_p(validation_output_folder)
-
-            # we cannot use self.get_tr_and_val_datasets() here because we might be DDP and then we have to distribute
-            # the validation keys across the workers.
-            _, val_keys = self.do_split()
-            if self.is_ddp:
-                last_barrier_at_idx = len(val_keys) // dist.get_world_size() - 1
-
-                val_keys = val_keys[self.local_rank:: dist.get_world_size()]
-                # we cannot just have barriers all over the place because the number of keys each GPU receives can be
-                # different
-
-            dataset_val = nnUNetDataset(self.preprocessed_dataset_folder, val_keys,
-                                        folder_with_segs_from_previous_stage=self.folder_with_segs_from_previous_stage,
-                                        num_images_properties_loading_threshold=0)
-
-            next_stages = self.configuration_manager.next_stage_names
-
-            if next_stages is not None:
-                _ = [maybe_mkdir_p(join(self.output_folder_base, 'predicted_next_stage', n)) for n in next_stages]
-
-            results = []
-
-            for i, k in enumerate(dataset_val.keys()):
-                proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
-                                                           allowed_num_queued=2)
-                while not proceed:
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
-                                                               allowed_num_queued=2)
-
-                self.print_to_log_file(f"predicting {k}")
-                data, seg, properties = dataset_val.load_case(k)
-
-                if self.is_cascaded:
-                    data = np.vstack((data, convert_labelmap_to_one_hot(seg[-1], self.label_manager.foreground_labels,
-                                                                        output_dtype=data.dtype)))
-                with warnings.catch_warnings():
-                    # ignore 'The given NumPy array is not writable' warning
-                    warnings.simplefilter("ignore")
-                    data = torch.from_numpy(data)
-
-                self.print_to_log_file(f'{k}, shape {data.shape}, rank {self.local_rank}')
-                output_filename_truncated = join(validation_output_folder, k)
-
-                prediction = predictor.predict_sliding_window_return_logits(data)
-                prediction = prediction.cpu()
-
-                # this needs to go into background processes
-                results.append(
-                    segmentation_export_pool.starmap_async(
-                        export_prediction_from_logits, (
-                            (prediction, properties, self.configuration_manager, self.plans_manager,
-                             self.dataset_json, output_filename_truncated, save_probabilities),
+        segmentation_export_pool = self._get_export_pool()
+        worker_list = [i for i in segmentation_export_pool._pool]
+        validation_output_folder = join(self.output_folder, 'validation')
+        maybe_mkdir_p(validation_output_folder)
+
+        # we cannot use self.get_tr_and_val_datasets() here because we might be DDP and then we have to distribute
+        # the validation keys across the workers.
+        _, val_keys = self.do_split()
+        # largest cases first. They take the longest to predict and export and should not be the ones the export
+        # pool is still busy with when everything else is done. Small cases backfill at the end (and can be grouped,
+        # see _predict_validation_cases). With DDP this also balances the load across the ranks
+        val_keys = self._sort_keys_by_size(val_keys)
+        if self.is_ddp:
+            last_barrier_at_idx = len(val_keys) // dist.get_world_size() - 1
+
+            val_keys = val_keys[self.local_rank:: dist.get_world_size()]
+            # we cannot just have barriers all over the place because the number of keys each GPU receives can be
+            # different
+
+        # the reference segmentations are not needed here, the metrics are computed against gt_segmentations. With
+        # load_segmentation=False, seg only holds the segmentation of the previous stage. nnUNetDataset sorts the list
+        # it gets in place, so it gets a copy
+        dataset_val = nnUNetValidationDataset(
+            self.preprocessed_dataset_folder, list(val_keys),
+            folder_with_segs_from_previous_stage=self.folder_with_segs_from_previous_stage,
+            num_images_properties_loading_threshold=0, load_segmentation=False)
+
+        next_stages = self.configuration_manager.next_stage_names
+
+        if next_stages is not None:
+            _ = [maybe_mkdir_p(join(self.output_folder_base, 'predicted_next_stage', n)) for n in next_stages]
+
+        results = []
+        # (key, results of a case, prediction handed to the workers). Predictions are released once all their
+        # results are ready
+        pending_exports = []
+        # every rank computes the metrics of its own cases, in the export pool and as soon as a case is exported.
+        # That way this overlaps with the prediction of the remaining cases and rank 0 does not have to do it all at
+        # the end while the other ranks wait
+        metric_results = []
+        regions_or_labels = self.label_manager.foreground_regions if self.label_manager.has_regions else \
+            self.label_manager.foreground_labels
+        image_reader_writer = self.plans_manager.image_reader_writer_class()
+        file_ending = self.dataset_json["file_ending"]
+
+        def collect_finished_exports(wait: bool):
+            # get() makes sure errors in the workers surface right away
+            still_pending = []
+            for key, pending_results, pending_prediction in pending_exports:
+                if wait or all([r.ready() for r in pending_results]):
+                    _ = [r.get() for r in pending_results]
+                    release_prediction_for_export(pending_prediction)
+                    metric_results.append(segmentation_export_pool.starmap_async(
+                        compute_metrics, (
+                            (join(self.preprocessed_dataset_folder_base, 'gt_segmentations', key + file_ending),
+                             join(validation_output_folder, key + file_ending), image_reader_writer,
+                             regions_or_labels, self.label_manager.ignore_label),
                         )
+                    ))
+                else:
+                    still_pending.append((key, pending_results, pending_prediction))
+            return still_pending
+        # pinned host memory for the predictions, see below
+        host_buffer = None
+
+        for i, (k, prediction, properties) in enumerate(self._predict_validation_cases(predictor, dataset_val,
+                                                                                       val_keys)):
+            output_filename_truncated = join(validation_output_folder, k)
+
+            # copy the prediction to the host asynchronously into a reused pinned buffer (allocating pinned memory
+            # is slow, pageable memory makes the copy slow and blocking). While the copy runs we look up what the
+            # next stages need
+            d2h_done = None
+            if prediction.device.type == 'cuda':
+                if host_buffer is None or host_buffer.dtype != prediction.dtype or \
+                        host_buffer.numel() < prediction.numel():
+                    host_buffer = None  # free the old one before allocating the new one
+                    host_buffer = torch.empty(prediction.numel(), dtype=prediction.dtype, pin_memory=True)
+                prediction = host_buffer[:prediction.numel()].view(prediction.shape).copy_(prediction,
+                                                                                           non_blocking=True)
+                d2h_done = torch.cuda.Event()
+                d2h_done.record()
+
+            # if needed, export the softmax prediction for the next stage
+            next_stage_targets = []
+            if next_stages is not None:
+                for n in next_stages:
+                    next_stage_config_manager = self.plans_manager.get_configuration(n)
+                    expected_preprocessed_folder = join(nnUNet_preprocessed, self.plans_manager.dataset_name,
+                                                        next_stage_config_manager.data_identifier)
+
+                    try:
+                        # we do this so that we can use load_case and do not have to hard code how loading training cases is implemented
+                        tmp = nnUNetValidationDataset(expected_preprocessed_folder, [k],
+                                                      num_images_properties_loading_threshold=0,
+                                                      load_segmentation=False)
+                        d, s, p = tmp.load_case(k)
+                    except FileNotFoundError:
+                        self.print_to_log_file(
+                            f"Predicting next stage {n} failed for case {k} because the preprocessed file is missing! "
+                            f"Run the preprocessing for this configuration first!")
+                        continue
+
+                    target_shape = d.shape[1:]
+                    output_folder = join(self.output_folder_base, 'predicted_next_stage', n)
+                    output_file = join(output_folder, k + '.npz')
+                    next_stage_targets.append((target_shape, output_file))
+
+            if d2h_done is not None:
+                d2h_done.synchronize()
+            # the workers get the prediction through shared memory (or from disk if there is not enough of it).
+            # That way we don't have to pickle the array and predictions waiting in the task queue do not pile up.
+            # This copies the prediction, so host_buffer is free to be reused for the next case afterwards
+            prediction = prepare_prediction_for_export(prediction, output_filename_truncated)
+            case_results = []
+
+            # this needs to go into background processes
+            case_results.append(
+                segmentation_export_pool.starmap_async(
+                    export_prediction_from_logits, (
+                        (prediction, properties, self.configuration_manager, self.plans_manager,
+                         self.dataset_json, output_filename_truncated, save_probabilities, 1),
                     )
                 )
-                # for debug purposes
-                # export_prediction(prediction_for_export, properties, self.configuration, self.plans, self.dataset_json,
-                #              output_filename_truncated, save_probabilities)
-
-                # if needed, export the softmax prediction for the next stage
-                if next_stages is not None:
-                    for n in next_stages:
-                        next_stage_config_manager = self.plans_manager.get_configuration(n)
-                        expected_preprocessed_folder = join(nnUNet_preprocessed, self.plans_manager.dataset_name,
-                                                            next_stage_config_manager.data_identifier)
-
-                        try:
-                            # we do this so that we can use load_case and do not have to hard code how loading training cases is implemented
-                            tmp = nnUNetDataset(expected_preprocessed_folder, [k],
-                                                num_images_properties_loading_threshold=0)
-                            d, s, p = tmp.load_case(k)
-                        except FileNotFoundError:
-                            self.print_to_log_file(
-                                f"Predicting next stage {n} failed for case {k} because the preprocessed file is missing! "
-                                f"Run the preprocessing for this configuration first!")
-                            continue
-
-                        target_shape = d.shape[1:]
-                        output_folder = join(self.output_folder_base, 'predicted_next_stage', n)
-                        output_file = join(output_folder, k + '.npz')
-
-                        # resample_and_save(prediction, target_shape, output_file, self.plans_manager, self.configuration_manager, properties,
-                        #                   self.dataset_json)
-                        results.append(segmentation_export_pool.starmap_async(
-                            resample_and_save, (
-                                (prediction, target_shape, output_file, self.plans_manager,
-                                 self.configuration_manager,
-                                 properties,
-                                 self.dataset_json),
-                            )
-                        ))
-                # if we don't barrier from time to time we will get nccl timeouts for large datasets. Yuck.
-                if self.is_ddp and i < last_barrier_at_idx and (i + 1) % 20 == 0:
-                    dist.barrier()
-
-            _ = [r.get() for r in results]
+            )
+            # for debug purposes
+            # export_prediction(prediction_for_export, properties, self.configuration, self.plans, self.dataset_json,
+            #              output_filename_truncated, save_probabilities)
+
+            for target_shape, output_file in next_stage_targets:
+                # resample_and_save(prediction, target_shape, output_file, self.plans_manager, self.configuration_manager, properties,
+                #                   self.dataset_json)
+                case_results.append(segmentation_export_pool.starmap_async(
+                    resample_and_save, (
+                        (prediction, target_shape, output_file, self.plans_manager,
+                         self.configuration_manager,
+                         properties,
+                         self.dataset_json, 1),
+                    )
+                ))
+            pending_exports.append((k, case_results, prediction))
+
+            # collect finished exports as we go
+            pending_exports = collect_finished_exports(wait=False)
+            results = [r for _, pending_results, _ in pending_exports for r in pending_results] + \
+                      [r for r in metric_results if not r.ready()]
+
+            # don't predict the next case(s) before the export workers have caught up. Workers retired because of
+            # maxtasksperchild get replaced, we need to keep an eye on the new ones as well
+            worker_list += [w for w in segmentation_export_pool._pool if w not in worker_list]
+            proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
+                                                       allowed_num_queued=2)
+            while not proceed:
+                sleep(0.1)
+                proceed = not check_workers_alive_and_busy(segmentation_export_pool, worker_list, results,
+                                                           allowed_num_queued=2)
+
+            # if we don't barrier from time to time we will get nccl timeouts for large datasets. Yuck.
+            if self.is_ddp and i < last_barrier_at_idx and (i + 1) % 20 == 0:
+                dist.barrier()
 
+        pending_exports = collect_finished_exports(wait=True)
+        metrics_per_case = [r.get()[0] for r in metric_results]
+
+        # rank 0 stitches together the metrics of all ranks. all_gather_object also is our final barrier. We cannot
+        # use monitored_barrier because that is only supported by gloo
         if self.is_ddp:
-            dist.barrier()
+            metrics_per_rank = [None] * dist.get_world_size()
+            dist.all_gather_object(metrics_per_rank, metrics_per_case)
+            metrics_per_case = [i for j in metrics_per_rank for i in j]
 
         if self.local_rank == 0:
-            metrics = compute_metrics_on_folder(join(self.preprocessed_dataset_folder_base, 'gt_segmentations'),
-                                                validation_output_folder,
-                                                join(validation_output_folder, 'summary.json'),
-                                                self.plans_manager.image_reader_writer_class(),
-                                                self.dataset_json["file_ending"],
-                                                self.label_manager.foreground_regions if self.label_manager.has_regions else
-                                                self.label_manager.foreground_labels,
-                                                self.label_manager.ignore_label, chill=True,
-                                                num_processes=default_num_processes * dist.get_world_size() if
-                                                self.is_ddp else default_num_processes)
+            # same order as compute_metrics_on_folder
+            metrics_per_case.sort(key=lambda x: x['prediction_file'])
+            metrics = summarize_metrics_per_case(metrics_per_case, regions_or_labels)
+            save_summary_json(metrics, join(validation_output_folder, 'summary.json'))
             self.print_to_log_file("Validation complete", also_print_to_console=True)
             self.print_to_log_file("Mean Validation Dice: ", (metrics['foreground_mean']["Dice"]),
                                    also_print_to_console=True)
 
         self.set_deep_supervision_enabled(True)
-        compute_gaussian.cache_clear()
 
     def run_training(self):
         self.on_train_start()
@@ -97,8 +97,12 @@ def check_workers_alive_and_busy(export_pool: Pool, worker_list: List, results_l
     """
 
     returns True if the number of results that are not ready is greater than the number of available workers + allowed_num_queued
+
+    Workers that exited with exit code 0 are considered fine. These have been retired by the pool (maxtasksperchild)
+    and are replaced automatically. Anything else (for example being killed by the OS because RAM ran out) raises an
+    error
     """
-    alive = [i.is_alive() for i in worker_list]
+    alive = [i.is_alive() or i.exitcode == 0 for i in worker_list]
     if not all(alive):
         raise RuntimeError('Some background workers are no longer alive')
 
@@ -11,6 +11,11 @@ import nnunetv2
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from nnunetv2.utilities.helpers import softmax_helper_dim0
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 from typing import TYPE_CHECKING
 
 # see https://adamj.eu/tech/2021/05/13/python-type-hints-how-to-fix-circular-imports/
@@ -245,14 +250,35 @@ def get_labelmanager_class_from_plans(plans: dict) -> Type[LabelManager]:
         return labelmanager_class
 
 
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def _fill_one_hot_numba(segmentation_flat: np.ndarray, all_labels: np.ndarray, out_flat: np.ndarray) -> None:
+        # one pass over the segmentation instead of one per label. Single threaded on purpose: this runs in
+        # background threads and worker processes which already provide the parallelism. nogil lets those threads
+        # run concurrently
+        for i in range(segmentation_flat.shape[0]):
+            v = segmentation_flat[i]
+            for k in range(all_labels.shape[0]):
+                out_flat[k, i] = 1 if v == all_labels[k] else 0
+else:
+    _fill_one_hot_numba = None
+
+
 def convert_labelmap_to_one_hot(segmentation: Union[np.ndarray, torch.Tensor],
                                 all_labels: Union[List, torch.Tensor, np.ndarray, tuple],
-                                output_dtype=None) -> Union[np.ndarray, torch.Tensor]:
+                                output_dtype=None,
+                                out: Union[np.ndarray, torch.Tensor] = None) -> Union[np.ndarray, torch.Tensor]:
     """
     if output_dtype is None then we use np.uint8/torch.uint8
     if input is torch.Tensor then output will be on the same device
 
-    np.ndarray is faster than torch.Tensor
+    out can be used to write the result into an existing array (must have shape (len(all_labels), *segmentation.shape)
+    and the same type as segmentation). This is useful if the one hot encoding is to be stacked with other data
+    anyway: preallocate the final array and pass the corresponding slice of it as out. output_dtype is ignored if out
+    is given
+
+    np.ndarray is faster than torch.Tensor. If numba is installed, np.ndarray uses a jit compiled kernel which is faster
+    still (the first call per dtype compiles and takes a moment, the result is cached on disk)
 
     if segmentation is torch.Tensor, this function will be faster if it is LongTensor. If it is somethine else we have
     to cast which takes time.
@@ -260,21 +286,37 @@ def convert_labelmap_to_one_hot(segmentation: Union[np.ndarray, torch.Tensor],
     IMPORTANT: This function only works properly if your labels are consecutive integers, so something like 0, 1, 2, 3, ...
     DO NOT use it with 0, 32, 123, 255, ... or whatever (fix your labels, yo)
     """
+    if out is not None:
+        assert tuple(out.shape) == (len(all_labels), *segmentation.shape), \
+            f'out has shape {tuple(out.shape)}, expected {(len(all_labels), *segmentation.shape)}'
     if isinstance(segmentation, torch.Tensor):
-        result = torch.zeros((len(all_labels), *segmentation.shape),
-                             dtype=output_dtype if output_dtype is not None else torch.uint8,
-                             device=segmentation.device)
+        if out is not None:
+            result = out
+            result.zero_()
+        else:
+            result = torch.zeros((len(all_labels), *segmentation.shape),
+                                 dtype=output_dtype if output_dtype is not None else torch.uint8,
+                                 device=segmentation.device)
         # variant 1, 2x faster than 2
         result.scatter_(0, segmentation[None].long(), 1)  # why does this have to be long!?
         # variant 2, slower than 1
         # for i, l in enumerate(all_labels):
         #     result[i] = segmentation == l
     else:
-        result = np.zeros((len(all_labels), *segmentation.shape),
-                          dtype=output_dtype if output_dtype is not None else np.uint8)
-        # variant 1, fastest in my testing
-        for i, l in enumerate(all_labels):
-            result[i] = segmentation == l
+        # every channel is written below so we don't need to zero out
+        if out is not None:
+            result = out
+        else:
+            result = np.zeros((len(all_labels), *segmentation.shape),
+                              dtype=output_dtype if output_dtype is not None else np.uint8)
+        if _fill_one_hot_numba is not None and result.flags.c_contiguous:
+            # reshape of a c contiguous array is a view, so the kernel writes into result
+            _fill_one_hot_numba(np.ascontiguousarray(segmentation).reshape(-1), np.asarray(all_labels),
+                                result.reshape((len(all_labels), -1)))
+        else:
+            # variant 1, fastest in my testing
+            for i, l in enumerate(all_labels):
+                result[i] = segmentation == l
         # variant 2. Takes about twice as long so nah
         # result = np.eye(len(all_labels))[segmentation].transpose((3, 0, 1, 2))
     return result